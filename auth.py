@@ -0,0 +1,130 @@
+from threading import Lock, Timer
+from time import monotonic
+
+import requests
+from nio.properties import IntProperty, PropertyHolder, StringProperty
+
+
+class OAuth2Creds(PropertyHolder):
+    token_url = StringProperty(title='Token URL', allow_none=True, order=0)
+    client_id = StringProperty(title='Client ID', allow_none=True, order=1)
+    client_secret = StringProperty(title='Client Secret',
+                                   allow_none=True,
+                                   order=2)
+    scope = StringProperty(title='Scope', allow_none=True, order=3)
+    refresh_margin = IntProperty(title='Refresh Before Expiry (seconds)',
+                                 default=60,
+                                 order=4)
+
+
+class ClientCredentialsToken(object):
+
+    """ An OAuth2 access token from the client credentials grant.
+
+    The token is cached in memory and refreshed on a background timer
+    `refresh_margin` seconds before it expires, so requests don't wait for
+    the token endpoint. If a refresh fails, the current token is used until
+    it expires, and then the next request fetches a token itself.
+    """
+
+    # lifetime assumed when the token response has no expires_in
+    default_expires_in = 3600
+
+    def __init__(self, token_url, client_id, client_secret, scope=None,
+                 refresh_margin=60, verify=True, timeout=None, logger=None):
+        self._token_url = token_url
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._scope = scope
+        self._refresh_margin = refresh_margin
+        self._verify = verify
+        self._timeout = timeout
+        self._logger = logger
+        self._lock = Lock()
+        self._token = None
+        self._expires_at = None
+        self._timer = None
+        self._stopped = False
+
+    def get(self):
+        """ Return a valid access token, fetching one if needed """
+        token, expires_at = self._token, self._expires_at
+        if token is not None and monotonic() < expires_at:
+            return token
+        with self._lock:
+            if self._token is None or monotonic() >= self._expires_at:
+                self._store(*self._request_token())
+            return self._token
+
+    def invalidate(self, token):
+        """ Drop the cached token if it is still the one that was rejected """
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _request_token(self):
+        data = {'grant_type': 'client_credentials'}
+        if self._scope:
+            data['scope'] = self._scope
+        r = requests.post(self._token_url, data=data,
+                          auth=(self._client_id, self._client_secret),
+                          verify=self._verify, timeout=self._timeout)
+        r.raise_for_status()
+        body = r.json()
+        return (body['access_token'],
+                float(body.get('expires_in') or self.default_expires_in))
+
+    def _store(self, token, expires_in):
+        """ Cache a new token and schedule its refresh; call with the lock """
+        # readers check the token without the lock, so set it last
+        self._expires_at = monotonic() + expires_in
+        self._token = token
+        refresh_in = expires_in - self._refresh_margin
+        if refresh_in <= 0:
+            refresh_in = expires_in / 2
+        if self._logger:
+            self._logger.debug(
+                "Fetched access token from {}, refreshing in {:.0f}s"
+                .format(self._token_url, refresh_in))
+        if self._timer:
+            self._timer.cancel()
+        if not self._stopped:
+            self._timer = Timer(refresh_in, self._refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _refresh(self):
+        # requests keep using the current token while this one is fetched
+        try:
+            token = self._request_token()
+        except Exception as e:
+            if self._logger:
+                self._logger.warning(
+                    "Failed to refresh access token from {}: {}"
+                    .format(self._token_url, e))
+            return
+        with self._lock:
+            self._store(*token)
+
+
+class BearerAuth(requests.auth.AuthBase):
+
+    """ Adds the current token of a token provider to each request, and
+    remembers the last token it added.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.token = None
+
+    def __call__(self, r):
+        self.token = self.provider.get()
+        r.headers['Authorization'] = 'Bearer {}'.format(self.token)
+        return r
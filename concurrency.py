@@ -0,0 +1,316 @@
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Lock
+from time import monotonic, time
+
+from nio.properties import (BoolProperty, FloatProperty, IntProperty,
+                            ListProperty, Property, PropertyHolder,
+                            StringProperty)
+from nio.util.threading import spawn
+
+
+class Concurrency(PropertyHolder):
+    enabled = BoolProperty(title='Concurrent Requests',
+                           default=False,
+                           allow_expr=False,
+                           order=0)
+    adaptive = BoolProperty(title='Adapt Limit to Latency and Errors',
+                            default=True,
+                            allow_expr=False,
+                            order=1)
+    initial_limit = IntProperty(title='Initial Limit',
+                                default=4,
+                                allow_expr=False,
+                                order=2)
+    min_limit = IntProperty(title='Minimum Limit',
+                            default=1,
+                            allow_expr=False,
+                            order=3)
+    max_limit = IntProperty(title='Maximum Limit',
+                            default=32,
+                            allow_expr=False,
+                            order=4)
+    latency_tolerance = FloatProperty(title='Latency Tolerance',
+                                      default=2.0,
+                                      allow_expr=False,
+                                      order=5)
+    backoff_ratio = FloatProperty(title='Backoff Ratio',
+                                  default=0.7,
+                                  allow_expr=False,
+                                  order=6)
+
+
+class Lane(PropertyHolder):
+    name = StringProperty(title='Name', default='', allow_expr=False, order=0)
+    share = FloatProperty(title='Concurrency Share',
+                          default=1.0,
+                          allow_expr=False,
+                          order=1)
+    deadline = FloatProperty(title='Deadline (seconds)',
+                             default=0,
+                             allow_expr=False,
+                             order=2)
+
+
+class Priority(PropertyHolder):
+    lane = Property(title='Lane', allow_none=True, order=0)
+    lanes = ListProperty(Lane,
+                         title='Lanes (highest priority first)',
+                         default=[],
+                         allow_expr=False,
+                         order=1)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AIMDLimiter(object):
+
+    """ Additive-increase/multiplicative-decrease concurrency limit.
+
+    While requests complete without errors and within `tolerance` times the
+    baseline (best observed) round trip time, and the limit is actually being
+    used, the limit grows by roughly one per `limit` samples. An error, a
+    429/5xx response or a round trip slower than tolerated multiplies the
+    limit by `backoff`, at most once per round trip so that a burst of
+    failures from requests already in flight only counts once.
+
+    Every change to the limit is kept in `history`.
+    """
+
+    # how quickly the baseline forgets a best-case round trip time, so that
+    # a permanent shift in upstream latency isn't treated as overload forever
+    baseline_drift = 0.01
+
+    def __init__(self, initial, minimum, maximum, tolerance=2.0, backoff=0.7,
+                 adaptive=True, history_size=100):
+        self._min = max(1, minimum)
+        self._max = max(self._min, maximum)
+        self._limit = float(min(max(initial, self._min), self._max))
+        self._tolerance = tolerance
+        self._backoff = backoff
+        self._adaptive = adaptive
+        self._baseline = None
+        self._last_decrease = 0
+        self._lock = Lock()
+        self.history = deque(maxlen=history_size)
+        self._record('initial')
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def baseline(self):
+        return self._baseline
+
+    def on_sample(self, rtt, failed, in_flight):
+        """ Adjust the limit with the outcome of one request.
+
+        Args:
+            rtt (float): Seconds the request took.
+            failed (bool): Whether the upstream errored or pushed back.
+            in_flight (int): Requests outstanding when this one started.
+        """
+        if not self._adaptive:
+            return
+        with self._lock:
+            now = monotonic()
+            if failed:
+                self._decrease(now, rtt, 'error')
+                return
+            if self._baseline is None or rtt < self._baseline:
+                self._baseline = rtt
+            else:
+                self._baseline += (rtt - self._baseline) * self.baseline_drift
+            if rtt > self._baseline * self._tolerance:
+                self._decrease(now, rtt, 'latency')
+            elif in_flight >= self.limit and self._limit < self._max:
+                previous = self.limit
+                self._limit = min(self._max, self._limit + 1 / self._limit)
+                if self.limit != previous:
+                    self._record('increase')
+
+    def _decrease(self, now, rtt, reason):
+        if now - self._last_decrease < rtt:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(self._min, self._limit * self._backoff)
+        if self.limit != previous:
+            self._record(reason)
+
+    def _record(self, reason):
+        self.history.append({
+            'time': time(),
+            'limit': self.limit,
+            'reason': reason,
+        })
+
+
+class _Lane(object):
+
+    """ Queue and statistics for one priority lane of a dispatcher """
+
+    # weight of the newest sample in the moving averages
+    smoothing = 0.2
+
+    def __init__(self, name, share=1.0, deadline=None):
+        self.name = name
+        self.share = share
+        self.deadline = deadline or None
+        self.queue = deque()
+        self.in_flight = 0
+        self.completed = 0
+        self.dropped = 0
+        self.wait = None
+        self.latency = None
+
+    def capacity(self, limit):
+        """ How many of `limit` concurrent requests this lane may use """
+        return max(1, int(limit * self.share))
+
+    def expire(self, now):
+        while self.queue and self.deadline and \
+                now - self.queue[0][4] >= self.deadline:
+            future = self.queue.popleft()[0]
+            self.dropped += 1
+            future.set_exception(DeadlineExceeded(
+                "Waited over {}s in lane {}".format(self.deadline, self.name)))
+
+    def next_expiry(self):
+        """ When the oldest queued call passes its deadline, if it has one """
+        if self.queue and self.deadline:
+            return self.queue[0][4] + self.deadline
+
+    def started(self, enqueued, now):
+        self.in_flight += 1
+        self.wait = self._average(self.wait, now - enqueued)
+
+    def finished(self, enqueued, now):
+        self.in_flight -= 1
+        self.completed += 1
+        self.latency = self._average(self.latency, now - enqueued)
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + (sample - average) * self.smoothing
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'wait': self.wait,
+            'latency': self.latency,
+        }
+
+
+class RequestDispatcher(object):
+
+    """ Runs submitted calls on worker threads, bounded by a limiter.
+
+    One worker is started per possible concurrent request; a worker only
+    picks up queued work while fewer calls than the limiter's current limit
+    are in flight.
+
+    Calls are queued in priority lanes, given as (name, share, deadline)
+    tuples from highest to lowest priority. A free worker takes the oldest
+    call from the highest priority lane that is using less than its share
+    of the limit, so low priority lanes fill whatever capacity is left.
+    Calls that wait longer than their lane's deadline fail with
+    DeadlineExceeded. Calls for an unknown lane go to the lowest priority
+    one.
+    """
+
+    def __init__(self, limiter, workers, lanes=None):
+        self.limiter = limiter
+        self.in_flight = 0
+        self._lanes = [_Lane(*lane) for lane in lanes or [('default',)]]
+        self._lanes_by_name = {lane.name: lane for lane in self._lanes}
+        self._condition = Condition()
+        self._stopped = False
+        for _ in range(workers):
+            spawn(self._work)
+
+    @property
+    def queued(self):
+        return sum(len(lane.queue) for lane in self._lanes)
+
+    def lane_stats(self):
+        with self._condition:
+            return {lane.name: lane.stats() for lane in self._lanes}
+
+    def submit(self, fn, *args, lane=None, **kwargs):
+        """ Queue a call and return a Future for its result """
+        future = Future()
+        with self._condition:
+            if self._stopped:
+                future.cancel()
+            else:
+                lane = self._lanes_by_name.get(lane, self._lanes[-1])
+                lane.queue.append((future, fn, args, kwargs, monotonic()))
+                self._condition.notify()
+        return future
+
+    def stop(self):
+        """ Stop the workers and cancel anything still queued """
+        with self._condition:
+            self._stopped = True
+            for lane in self._lanes:
+                while lane.queue:
+                    lane.queue.popleft()[0].cancel()
+            self._condition.notify_all()
+
+    def _next(self):
+        """ Pop the next call to run, or None if nothing may run now """
+        # expire every lane, even when nothing can run, so that callers
+        # waiting on overdue calls aren't held up by a saturated limit
+        now = monotonic()
+        for lane in self._lanes:
+            lane.expire(now)
+        limit = self.limiter.limit
+        if self.in_flight >= limit:
+            return None
+        for lane in self._lanes:
+            if lane.queue and lane.in_flight < lane.capacity(limit):
+                item = lane.queue.popleft()
+                lane.started(item[4], now)
+                return lane, item
+        return None
+
+    def _expiry_wait(self):
+        """ Seconds until a queued call passes its deadline, or None """
+        expiries = [expiry for expiry in
+                    (lane.next_expiry() for lane in self._lanes)
+                    if expiry is not None]
+        if expiries:
+            return max(0, min(expiries) - monotonic())
+
+    def _work(self):
+        while True:
+            with self._condition:
+                work = None
+                while not self._stopped:
+                    work = self._next()
+                    if work:
+                        break
+                    self._condition.wait(self._expiry_wait())
+                if self._stopped:
+                    return
+                lane, (future, fn, args, kwargs, enqueued) = work
+                self.in_flight += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except Exception as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self.in_flight -= 1
+                    lane.finished(enqueued, monotonic())
+                    self._condition.notify_all()
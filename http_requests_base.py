@@ -1,14 +1,32 @@
 import json
+import os
 import requests
+from concurrent.futures import CancelledError
 from enum import Enum
+from time import monotonic
+from urllib.parse import urlencode
 
 from nio.block.base import Block
 from nio.block.mixins import Retry, EnrichSignals
+from nio.command import command
 from nio.properties import (Property, IntProperty, BoolProperty,
                             PropertyHolder, ListProperty, ObjectProperty,
                             SelectProperty, StringProperty, VersionProperty)
 from nio.util.discovery import not_discoverable
 
+from .auth import BearerAuth, ClientCredentialsToken, OAuth2Creds
+from .concurrency import (AIMDLimiter, Concurrency, DeadlineExceeded,
+                          Priority, RequestDispatcher)
+from .polling import Poller, Polling
+from .pool import ConnectionPool, registry
+from .projection import (Projection, compile_paths, exclude_fields,
+                         include_fields)
+from .tracing import NULL_TRACE, SPAN_KIND_CLIENT, Tracer, Tracing
+from .traffic import (Traffic, TrafficMode, TrafficRecorder,
+                      TrafficReplayer)
+from .upload import (Upload, UploadSource, UploadStream, file_chunks,
+                     list_chunks)
+
 
 class Header(PropertyHolder):
     header = Property(title='Header', allow_none=True, order=0)
@@ -29,6 +47,20 @@ class HTTPMethod(Enum):
     OPTIONS = 'options'
 
 
+def _body_size(body):
+    """ Size of a request or response body in bytes, if it is known """
+    if isinstance(body, str):
+        return len(body.encode())
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, dict):
+        # form data is sent url encoded
+        return len(urlencode(body, doseq=True))
+    if isinstance(body, UploadStream):
+        return body.bytes_sent
+
+
+@command('concurrency_status')
 @not_discoverable
 class HTTPRequestsBase(Retry, EnrichSignals, Block):
 
@@ -39,6 +71,25 @@ class HTTPRequestsBase(Retry, EnrichSignals, Block):
         basic_auth_creds (obj): Basic Authentication credentials.
         http_method (select): HTTP method (ex. GET, POST,
             PUT, DELETE, etc).
+        oauth2_creds (obj): OAuth2 client credentials, used instead of
+            basic_auth_creds when a token url is set.
+        connection_pool (obj): Name of a connection pool shared with other
+            blocks in the process, and its connection limits.
+        upload (obj): Stream the request body from a file or a list
+            attribute instead of building it in memory.
+        concurrency (obj): Make requests for a list of signals
+            concurrently, with a limit that adapts to upstream latency
+            and errors.
+        projection (obj): Fields of the JSON response to include in, or
+            exclude from, output signals.
+        tracing (obj): Export sampled trace spans for each stage of a
+            request to a file or an OTLP/HTTP collector.
+        polling (obj): Poll the url of each incoming signal on an interval
+            and only emit signals when its content changes.
+        traffic (obj): Record requests and responses to a log, or replay
+            responses from one instead of calling the upstream.
+        priority (obj): Lane expression and priority lanes, each with its
+            own queue, share of the concurrency limit and deadline.
     """
     version = VersionProperty('0.1.0')
     url = Property(title='URL Target',
@@ -65,17 +116,232 @@ class HTTPRequestsBase(Retry, EnrichSignals, Block):
     timeout = IntProperty(
         title='Request Timeout', default=0, allow_none=True, advanced=True, order=6
     )
+    upload = ObjectProperty(Upload,
+                            title='Streaming Upload',
+                            default=Upload(),
+                            advanced=True,
+                            order=8)
+    concurrency = ObjectProperty(Concurrency,
+                                 title='Concurrency',
+                                 default=Concurrency(),
+                                 advanced=True,
+                                 order=9)
+    projection = ObjectProperty(Projection,
+                                title='Response Projection',
+                                default=Projection(),
+                                advanced=True,
+                                order=10)
+    tracing = ObjectProperty(Tracing,
+                             title='Tracing',
+                             default=Tracing(),
+                             advanced=True,
+                             order=11)
+    polling = ObjectProperty(Polling,
+                             title='Polling',
+                             default=Polling(),
+                             advanced=True,
+                             order=12)
+    traffic = ObjectProperty(Traffic,
+                             title='Traffic Record/Replay',
+                             default=Traffic(),
+                             advanced=True,
+                             order=13)
+    priority = ObjectProperty(Priority,
+                              title='Priority Lanes',
+                              default=Priority(),
+                              advanced=True,
+                              order=14)
+    oauth2_creds = ObjectProperty(OAuth2Creds,
+                                  title='Credentials (OAuth2)',
+                                  default=OAuth2Creds(),
+                                  advanced=True,
+                                  order=15)
+    connection_pool = ObjectProperty(ConnectionPool,
+                                     title='Shared Connection Pool',
+                                     default=ConnectionPool(),
+                                     advanced=True,
+                                     order=16)
+
+    def __init__(self):
+        super().__init__()
+        self._limiter = None
+        self._dispatcher = None
+        self._tracer = None
+        self._poller = None
+        self._recorder = None
+        self._replayer = None
+        self._token = None
+        self._pool = None
+        self._include = {}
+        self._exclude = {}
+
+    def configure(self, context):
+        super().configure(context)
+        traffic = self.traffic()
+        if traffic.mode() is not TrafficMode.OFF and not traffic.log_path():
+            raise ValueError("Traffic mode {} requires a log path".format(
+                traffic.mode().value))
+        self._include = compile_paths(
+            field.path() for field in self.projection().include())
+        self._exclude = compile_paths(
+            field.path() for field in self.projection().exclude())
+        self._limiter = None
+        concurrency = self.concurrency()
+        if concurrency.enabled():
+            self._limiter = AIMDLimiter(
+                concurrency.initial_limit(),
+                concurrency.min_limit(),
+                concurrency.max_limit(),
+                tolerance=concurrency.latency_tolerance(),
+                backoff=concurrency.backoff_ratio(),
+                adaptive=concurrency.adaptive())
+        self._token = None
+        oauth2 = self.oauth2_creds()
+        if oauth2.token_url():
+            self._token = ClientCredentialsToken(
+                oauth2.token_url(),
+                oauth2.client_id(),
+                oauth2.client_secret(),
+                scope=oauth2.scope(),
+                refresh_margin=oauth2.refresh_margin(),
+                verify=self.verify(),
+                timeout=self.timeout() or None,
+                logger=self.logger)
+        self._tracer = None
+        tracing = self.tracing()
+        if tracing.enabled():
+            self._tracer = Tracer(
+                self.name(),
+                sample_rate=tracing.sample_rate(),
+                file_path=tracing.file_path(),
+                endpoint=tracing.endpoint(),
+                flush_interval=tracing.flush_interval(),
+                logger=self.logger)
+
+    def start(self):
+        super().start()
+        pool = self.connection_pool()
+        if pool.name():
+            cert = pool.client_cert()
+            if cert and pool.client_key():
+                cert = (cert, pool.client_key())
+            self._pool = registry.acquire(
+                pool.name(),
+                verify=self.verify(),
+                cert=cert,
+                max_per_host=pool.max_per_host(),
+                max_total=pool.max_total())
+            self.logger.info(
+                "Using shared connection pool {} with {} block(s)"
+                .format(pool.name(), self._pool.users))
+        traffic = self.traffic()
+        if traffic.mode() is TrafficMode.RECORD:
+            self._recorder = TrafficRecorder(traffic.log_path())
+        elif traffic.mode() is TrafficMode.REPLAY:
+            self._replayer = TrafficReplayer(
+                traffic.log_path(),
+                reproduce_latency=traffic.reproduce_latency(),
+                speedup=traffic.speedup())
+            self.logger.info("Replaying {} recorded responses from {}".format(
+                self._replayer.entry_count, traffic.log_path()))
+        if self._tracer:
+            self._tracer.start()
+        if self._limiter:
+            self._dispatcher = RequestDispatcher(
+                self._limiter, self.concurrency().max_limit(),
+                lanes=[(lane.name(), lane.share(), lane.deadline())
+                       for lane in self.priority().lanes()])
+        elif self.priority().lanes():
+            self.logger.warning(
+                "Priority lanes are ignored unless concurrency is enabled")
+        polling = self.polling()
+        if polling.enabled():
+            if not self._dispatcher:
+                # polls get their own workers, so that one slow target
+                # doesn't hold up the others
+                workers = max(1, polling.workers())
+                self._dispatcher = RequestDispatcher(
+                    AIMDLimiter(workers, workers, workers, adaptive=False),
+                    workers)
+            self._poller = Poller(self._poll_target,
+                                  polling.interval(),
+                                  polling.jitter(),
+                                  max_targets=polling.max_targets())
+
+    def stop(self):
+        if self._poller:
+            self._poller.stop()
+            self._poller = None
+        if self._dispatcher:
+            self._dispatcher.stop()
+            self._dispatcher = None
+        if self._tracer:
+            self._tracer.stop()
+        if self._recorder:
+            self._recorder.close()
+            self._recorder = None
+        self._replayer = None
+        if self._token:
+            self._token.stop()
+        if self._pool:
+            registry.release(self._pool)
+            self._pool = None
+        super().stop()
 
     def process_signals(self, signals):
+        if self._poller:
+            for signal in signals:
+                self._add_poll_target(signal)
+            return
+        if self._dispatcher:
+            results = []
+            futures = [self._dispatcher.submit(self._make_request, signal,
+                                               lane=self._lane(signal))
+                       for signal in signals]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except CancelledError:
+                    # block stopped before this request was made
+                    pass
+                except DeadlineExceeded as e:
+                    self.logger.warning("Dropped request: {}".format(e))
+        else:
+            results = (self._make_request(signal) for signal in signals)
         new_signals = []
-        for signal in signals:
-            new_sigs = self._make_request(signal)
+        for new_sigs in results:
             if new_sigs:
                 new_signals.extend(new_sigs)
         if new_signals:
             self.notify_signals(new_signals)
 
-    def _make_request(self, signal):
+    def concurrency_status(self):
+        """ Report the current concurrency limit and its recent history """
+        if not self._limiter:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'limit': self._limiter.limit,
+            'baseline_rtt': self._limiter.baseline,
+            'in_flight': self._dispatcher.in_flight if self._dispatcher else 0,
+            'queued': self._dispatcher.queued if self._dispatcher else 0,
+            'history': list(self._limiter.history),
+            'lanes':
+                self._dispatcher.lane_stats() if self._dispatcher else {},
+        }
+
+    def _lane(self, signal):
+        if not self.priority().lanes():
+            return None
+        try:
+            return self.priority().lane(signal)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to evaluate lane {} for incoming signal {}: {}"
+                .format(self.priority().lane.value, signal.to_dict(), e)
+            )
+
+    def _add_poll_target(self, signal):
         try:
             url = self.url(signal)
         except Exception as e:
@@ -84,45 +350,175 @@ class HTTPRequestsBase(Retry, EnrichSignals, Block):
                 .format(self.url.value, signal.to_dict(), e)
             )
             return
-        timeout = self.timeout(signal) if self.timeout(signal) else None
-        auth = self._create_auth()
-        payload = self._create_payload(signal)
-        headers = self._create_headers(signal)
+        evicted = self._poller.add(url, signal)
+        if evicted:
+            self.logger.warning(
+                "Stopped polling {} to make room for {}".format(
+                    evicted.url, url))
+        self.logger.debug(
+            "Polling {} target(s)".format(self._poller.target_count))
+
+    def _poll_target(self, target):
+        future = self._dispatcher.submit(
+            self._poll, target, lane=self._lane(target.signal))
+        future.add_done_callback(
+            lambda future: self._poll_dropped(target, future))
+
+    def _poll_dropped(self, target, future):
+        # a poll that never ran has to be rescheduled here instead
+        if future.cancelled() or future.exception():
+            self._schedule_poll(target)
 
+    def _poll(self, target):
         try:
-            r = self.execute_with_retry(self._execute_request,
-                                        url, auth, payload, headers, timeout)
-        except:
-            # out of retries for this signal
-            return
+            new_signals = self._make_request(target.signal, target)
+            if new_signals:
+                self.notify_signals(new_signals)
+        except Exception:
+            self.logger.exception("Failed to poll {}".format(target.url))
+        finally:
+            self._schedule_poll(target)
 
-        if 200 <= r.status_code < 300:
-            return self._process_response(r, signal)
-        else:
-            self.logger.warning(
-                "{} request to {} returned with response code: {}".format(
-                    self.http_method(),
-                    url,
-                    r.status_code
+    def _schedule_poll(self, target):
+        poller = self._poller
+        if poller:
+            poller.schedule(target)
+
+    def _make_request(self, signal, poll=None):
+        trace = self._tracer.start_trace() if self._tracer else NULL_TRACE
+        with trace.span('http.request', **{
+                'url.template': self.url.value,
+                'http.request.method': self.http_method().value}) as request:
+            with trace.span('evaluate') as span:
+                try:
+                    url = self.url(signal)
+                except Exception as e:
+                    self.logger.warning(
+                        "Failed to evaluate url {} for incoming signal {}: {}"
+                        .format(self.url.value, signal.to_dict(), e)
+                    )
+                    span.set_error(e)
+                    return
+                timeout = self.timeout(signal) if self.timeout(signal) \
+                    else None
+                auth = self._create_auth()
+                headers = self._create_headers(signal)
+                if self.upload().source() is UploadSource.NONE:
+                    payload = self._create_payload(signal)
+                else:
+                    try:
+                        payload = self._create_upload(signal, headers)
+                    except Exception as e:
+                        self.logger.warning(
+                            "Failed to create upload stream for incoming "
+                            "signal {}: {}".format(signal.to_dict(), e)
+                        )
+                        span.set_error(e)
+                        return
+                if poll and self.polling().conditional():
+                    headers.update(poll.conditional_headers())
+                request.set('url.full', url)
+
+            try:
+                r = self.execute_with_retry(self._send, url, auth, payload,
+                                            headers, timeout, trace=trace)
+                if r.status_code == 401 and self._token:
+                    # the token may have been revoked before it expired
+                    self._token.invalidate(auth.token)
+                    r = self.execute_with_retry(self._send, url, auth,
+                                                payload, headers, timeout,
+                                                trace=trace)
+            except Exception as e:
+                # out of retries for this signal
+                request.set_error(e)
+                return
+            request.set('http.response.status_code', r.status_code)
+
+            if poll and not poll.changed(r):
+                self.logger.debug("{} has not changed".format(url))
+                return
+            if not 200 <= r.status_code < 300:
+                self.logger.warning(
+                    "{} request to {} returned with response code: {}".format(
+                        self.http_method(),
+                        url,
+                        r.status_code
+                    )
                 )
-            )
-            return self._process_response(r, signal)
+            with trace.span('process_response') as span:
+                signals = self._process_response(r, signal)
+                span.set('signals', len(signals))
+            return signals
+
+    def _send(self, url, auth, data, headers, timeout, trace=NULL_TRACE):
+        """ Make one attempt at the request, feeding the concurrency limit
+        and the trace.
+        """
+        in_flight = self._dispatcher.in_flight if self._dispatcher else 0
+        with trace.span('http.attempt', kind=SPAN_KIND_CLIENT,
+                        attempt=trace.next_attempt()) as span:
+            start = monotonic()
+            try:
+                r = self._execute_request(url, auth, data, headers, timeout)
+            except Exception:
+                if self._limiter:
+                    self._limiter.on_sample(monotonic() - start, True,
+                                            in_flight)
+                raise
+            if self._limiter:
+                failed = r.status_code == 429 or r.status_code >= 500
+                self._limiter.on_sample(monotonic() - start, failed,
+                                        in_flight)
+            if trace is NULL_TRACE:
+                # measuring bodies costs too much for unsampled requests
+                return r
+            span.set('http.response.status_code', r.status_code)
+            request_size = _body_size(data)
+            if request_size is not None:
+                span.set('http.request.body.size', request_size)
+            response_size = _body_size(r.content)
+            if response_size is not None:
+                span.set('http.response.body.size', response_size)
+            return r
 
     def _execute_request(self, url, auth, data, headers, timeout):
-        method = getattr(requests, self.http_method().value)
+        if self._replayer:
+            return self._replayer.respond(self.http_method().value, url)
 
         self.logger.debug("Executing {} request to {} with data: {}"
                           .format(self.http_method(), url,
                                   {"auth": auth, "data": data,
                                    "headers": headers, "timeout": timeout}))
 
+        # stop() may clear the recorder while this request is in flight
+        recorder = self._recorder
+        if not recorder:
+            return self._open(url, auth, data, headers, timeout)
+        start = monotonic()
+        try:
+            r = self._open(url, auth, data, headers, timeout)
+        except Exception as e:
+            recorder.record(self.http_method().value, url, headers, data,
+                            monotonic() - start, error=e)
+            raise
+        recorder.record(self.http_method().value, url, headers, data,
+                        monotonic() - start, response=r)
+        return r
+
+    def _open(self, url, auth, data, headers, timeout):
+        """ Send the request, through the shared pool if there is one """
+        if self._pool:
+            return self._pool.request(self.http_method().value, url,
+                                      auth=auth, data=data, headers=headers,
+                                      timeout=timeout)
+        method = getattr(requests, self.http_method().value)
         return method(url, auth=auth, data=data, headers=headers,
                       verify=self.verify(), timeout=timeout)
 
     def _process_response(self, response, signal):
         result = []
         try:
-            data = response.json()
+            data = self._project(response.json())
 
             # if the response is a dictionary, build a signal
             if isinstance(data, dict):
@@ -173,7 +569,17 @@ class HTTPRequestsBase(Retry, EnrichSignals, Block):
                                       response.__dict__))
             return result
 
+    def _project(self, data):
+        """ Drop response fields that should not become signal attributes """
+        if self._include:
+            data = include_fields(data, self._include)
+        if self._exclude:
+            data = exclude_fields(data, self._exclude)
+        return data
+
     def _create_auth(self):
+        if self._token:
+            return BearerAuth(self._token)
         if self.basic_auth_creds().username():
             return requests.auth.HTTPBasicAuth(
                 self.basic_auth_creds().username(),
@@ -183,6 +589,37 @@ class HTTPRequestsBase(Retry, EnrichSignals, Block):
     def _create_payload(self, signal):
         return json.dumps(signal.to_dict())
 
+    def _create_upload(self, signal, headers):
+        """ Build a streaming body and set the headers that describe it """
+        upload = self.upload()
+        chunk_size = upload.chunk_size()
+        if upload.source() is UploadSource.FILE:
+            path = upload.file_path(signal)
+            # pipes and other special files are streamed too
+            if os.path.isdir(path) or not os.access(path, os.R_OK):
+                raise ValueError("{} is not a readable file".format(path))
+            stream = UploadStream(lambda: file_chunks(path, chunk_size),
+                                  path, self.logger,
+                                  compress=upload.compress(),
+                                  total=os.path.getsize(path)
+                                  if os.path.isfile(path) else None)
+            content_type = 'application/octet-stream'
+        else:
+            items = upload.attribute(signal)
+            if not isinstance(items, (list, tuple)):
+                raise TypeError("List Attribute evaluated to {}, not a list"
+                                .format(type(items).__name__))
+            stream = UploadStream(lambda: list_chunks(items, chunk_size),
+                                  "list of {} items".format(len(items)),
+                                  self.logger,
+                                  compress=upload.compress())
+            content_type = 'application/x-ndjson'
+        if not any(h.lower() == 'content-type' for h in headers):
+            headers['Content-Type'] = content_type
+        if upload.compress():
+            headers['Content-Encoding'] = 'gzip'
+        return stream
+
     def _create_headers(self, signal):
         headers = {}
         for header in self.headers():
@@ -15,7 +15,7 @@ class HTTPRequestsPostSignal(HTTPRequestsBase):
         http_method (select): HTTP method (ex. GET, POST,
             PUT, DELETE, etc).
     """
-    version = VersionProperty("0.2.0")
+    version = VersionProperty("0.11.0")
     http_method = SelectProperty(
         HTTPMethod,
         default=HTTPMethod.POST,
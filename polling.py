@@ -0,0 +1,180 @@
+import heapq
+import random
+from collections import OrderedDict
+from hashlib import blake2b
+from itertools import count
+from threading import Condition
+from time import monotonic
+
+from nio.properties import (BoolProperty, FloatProperty, IntProperty,
+                            PropertyHolder)
+from nio.util.threading import spawn
+
+
+class Polling(PropertyHolder):
+    enabled = BoolProperty(title='Poll Targets',
+                           default=False,
+                           allow_expr=False,
+                           order=0)
+    interval = FloatProperty(title='Poll Interval (seconds)',
+                             default=60,
+                             allow_expr=False,
+                             order=1)
+    jitter = FloatProperty(title='Jitter (fraction of interval)',
+                           default=0.1,
+                           allow_expr=False,
+                           order=2)
+    conditional = BoolProperty(title='Send Conditional Requests',
+                               default=True,
+                               allow_expr=False,
+                               order=3)
+    workers = IntProperty(title='Concurrent Polls',
+                          default=8,
+                          allow_expr=False,
+                          order=4)
+    max_targets = IntProperty(title='Max Targets',
+                              default=10000,
+                              allow_expr=False,
+                              order=5)
+
+
+class PollTarget(object):
+
+    """ What is remembered between polls of one url.
+
+    Only validators, the last status code and a 16 byte digest of the last
+    body are kept, so thousands of targets take little memory.
+    """
+
+    __slots__ = ('url', 'signal', 'etag', 'last_modified', 'status',
+                 'digest')
+
+    def __init__(self, url, signal):
+        self.url = url
+        self.signal = signal
+        self.etag = None
+        self.last_modified = None
+        self.status = None
+        self.digest = None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def changed(self, response):
+        """ Update from a response, returning whether it should be emitted.
+
+        A response is emitted when its status code or body differs from the
+        last one, so a failing endpoint is reported once, not on every poll.
+        Validators are only taken from successful responses.
+        """
+        if response.status_code == 304:
+            return False
+        if 200 <= response.status_code < 300:
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+        digest = blake2b(response.content, digest_size=16).digest()
+        if response.status_code == self.status and digest == self.digest:
+            return False
+        self.status = response.status_code
+        self.digest = digest
+        return True
+
+
+class Poller(object):
+
+    """ Schedules registered targets on jittered intervals from one thread.
+
+    Due targets are handed to `poll`, which must call `schedule` with the
+    target once it is done, so that slow polls of a target never overlap.
+    `poll` should hand the request off to other threads, so a slow target
+    doesn't hold up the rest.
+
+    At most `max_targets` targets are kept; registering one more stops
+    polling the target that was least recently registered.
+    """
+
+    def __init__(self, poll, interval, jitter, max_targets=None):
+        self._poll = poll
+        self._interval = interval
+        self._jitter = jitter
+        self._max_targets = max_targets
+        self._targets = OrderedDict()
+        self._due = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._stopped = False
+        spawn(self._run)
+
+    @property
+    def target_count(self):
+        return len(self._targets)
+
+    def add(self, url, signal):
+        """ Start polling a url, or update the signal it is polled with.
+
+        Returns the target that was evicted to make room, if any.
+        """
+        with self._condition:
+            target = self._targets.get(url)
+            if target:
+                target.signal = signal
+                self._targets.move_to_end(url)
+                return
+            evicted = None
+            if self._max_targets and \
+                    len(self._targets) >= self._max_targets:
+                evicted = self._targets.popitem(last=False)[1]
+            target = self._targets[url] = PollTarget(url, signal)
+            # spread the first polls of targets registered together
+            self._push(target, random.uniform(
+                0, self._interval * self._jitter))
+            return evicted
+
+    def remove(self, url):
+        """ Stop polling a url, returning its target if it was polled """
+        with self._condition:
+            return self._targets.pop(url, None)
+
+    def schedule(self, target):
+        with self._condition:
+            if self._stopped or not self._polled(target):
+                return
+            self._push(target, self._interval * random.uniform(
+                1 - self._jitter, 1 + self._jitter))
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _polled(self, target):
+        # a removed url may have been registered again with a new target
+        return self._targets.get(target.url) is target
+
+    def _push(self, target, delay):
+        heapq.heappush(
+            self._due, (monotonic() + delay, next(self._sequence), target))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._due:
+                        wait = self._due[0][0] - monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                if self._stopped:
+                    return
+                target = heapq.heappop(self._due)[2]
+                if not self._polled(target):
+                    continue
+            self._poll(target)
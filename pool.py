@@ -0,0 +1,102 @@
+from http.cookiejar import DefaultCookiePolicy
+from threading import BoundedSemaphore, Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from nio.properties import IntProperty, PropertyHolder, StringProperty
+
+
+class ConnectionPool(PropertyHolder):
+    name = StringProperty(title='Shared Pool Name',
+                          allow_none=True,
+                          allow_expr=False,
+                          order=0)
+    max_per_host = IntProperty(title='Max Connections per Host',
+                               default=10,
+                               allow_expr=False,
+                               order=1)
+    max_total = IntProperty(title='Max Connections',
+                            default=100,
+                            allow_expr=False,
+                            order=2)
+    client_cert = StringProperty(title='Client Certificate File',
+                                 allow_none=True,
+                                 allow_expr=False,
+                                 order=3)
+    client_key = StringProperty(title='Client Key File',
+                                allow_none=True,
+                                allow_expr=False,
+                                order=4)
+
+
+class SharedPool(object):
+
+    """ A requests Session shared by the blocks that use the same pool.
+
+    Each host gets at most `max_per_host` connections; requests wait for a
+    free one rather than opening more. At most `max_total` requests are in
+    flight through the pool, and idle connections are kept for no more
+    hosts than that allows, which bounds the sockets the pool holds open.
+
+    Only connections are shared: the session keeps no cookies, so one
+    user's responses never change what another user sends.
+    """
+
+    def __init__(self, key, verify, cert, max_per_host, max_total):
+        self.key = key
+        self.users = 0
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.cert = cert
+        self.session.cookies.set_policy(
+            DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=max(1, max_total // max(1, max_per_host)),
+            pool_maxsize=max_per_host,
+            pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = BoundedSemaphore(max_total)
+
+    def request(self, method, url, **kwargs):
+        # passed explicitly, or REQUESTS_CA_BUNDLE would override verify
+        with self._slots:
+            return self.session.request(method, url,
+                                        verify=self.session.verify,
+                                        cert=self.session.cert, **kwargs)
+
+
+class PoolRegistry(object):
+
+    """ Process-wide, reference counted registry of shared pools.
+
+    Pools are keyed by name and TLS settings, so blocks only share
+    connections when they would make them the same way. Limits are taken
+    from the first block to acquire a pool. A pool's connections are
+    closed when its last user releases it.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = Lock()
+
+    def acquire(self, name, verify=True, cert=None, max_per_host=10,
+                max_total=100):
+        key = (name, verify, cert)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = SharedPool(
+                    key, verify, cert, max_per_host, max_total)
+            pool.users += 1
+            return pool
+
+    def release(self, pool):
+        with self._lock:
+            pool.users -= 1
+            if pool.users <= 0:
+                self._pools.pop(pool.key, None)
+                pool.session.close()
+
+
+registry = PoolRegistry()
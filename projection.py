@@ -0,0 +1,59 @@
+from nio.properties import ListProperty, PropertyHolder, StringProperty
+
+
+class Field(PropertyHolder):
+    path = StringProperty(title='Field Path', allow_none=True,
+                          allow_expr=False)
+
+
+class Projection(PropertyHolder):
+    include = ListProperty(Field, title='Include Fields', default=[],
+                           allow_expr=False, order=0)
+    exclude = ListProperty(Field, title='Exclude Fields', default=[],
+                           allow_expr=False, order=1)
+
+
+def compile_paths(paths):
+    """ Turn dotted paths into a tree of nested dicts.
+
+    A leaf is `True`, meaning the whole field is selected.
+
+        >>> compile_paths(['id', 'user.name', 'user.email'])
+        {'id': True, 'user': {'name': True, 'email': True}}
+    """
+    tree = {}
+    for path in paths:
+        if not path:
+            continue
+        *parents, leaf = path.split('.')
+        node = tree
+        for part in parents:
+            node = node.setdefault(part, {})
+            if node is True:
+                # a parent field is already selected as a whole
+                break
+        else:
+            node[leaf] = True
+    return tree
+
+
+def include_fields(data, tree):
+    """ Keep only the fields of `tree`, mapping over lists """
+    if isinstance(data, dict):
+        return {key: data[key] if sub is True
+                else include_fields(data[key], sub)
+                for key, sub in tree.items() if key in data}
+    if isinstance(data, list):
+        return [include_fields(item, tree) for item in data]
+    return data
+
+
+def exclude_fields(data, tree):
+    """ Drop the fields of `tree`, mapping over lists """
+    if isinstance(data, dict):
+        return {key: value if key not in tree
+                else exclude_fields(value, tree[key])
+                for key, value in data.items() if tree.get(key) is not True}
+    if isinstance(data, list):
+        return [exclude_fields(item, tree) for item in data]
+    return data
@@ -1,10 +1,17 @@
-from threading import Event
+import gzip
+import json
+import os
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Lock, Thread
+from time import sleep
 from unittest.mock import MagicMock, patch
 
 from nio.block.terminals import DEFAULT_TERMINAL
 from nio.signal.base import Signal
 from nio.testing.block_test_case import NIOBlockTestCase
 
+from .. import http_requests_base
 from ..http_requests_block import HTTPRequests
 
 
@@ -392,3 +399,688 @@ class TestHTTPRequestsBlock(NIOBlockTestCase):
         block.process_signals([Signal({'input_attr': 'value'})])
         block.stop()
         self.assertEqual(self.last_notified[DEFAULT_TERMINAL][0].input_attr, 'value')
+
+    @patch('requests.post')
+    def test_upload_file(self, mock_post):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value={'uploaded': True})
+        bodies = []
+        mock_post.side_effect = \
+            lambda *args, **kwargs: bodies.append(
+                b''.join(kwargs['data'])) or resp
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'0123456789' * 10)
+        self.addCleanup(os.remove, f.name)
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "http_method": "POST",
+            "upload": {
+                "source": "file",
+                "file_path": "{{ $path }}",
+                "chunk_size": 7
+            }
+        })
+        block.start()
+        block.process_signals([Signal({'path': f.name})])
+        block.stop()
+        self.assertEqual(bodies, [b'0123456789' * 10])
+        headers = mock_post.call_args[1]['headers']
+        self.assertEqual(headers['Content-Type'], 'application/octet-stream')
+        self.assertTrue(self.last_notified[DEFAULT_TERMINAL][0].uploaded)
+
+    @patch('requests.post')
+    def test_upload_pipe(self, mock_post):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value={})
+        bodies = []
+        mock_post.side_effect = \
+            lambda *args, **kwargs: bodies.append(
+                b''.join(kwargs['data'])) or resp
+        pipe_dir = tempfile.mkdtemp()
+        path = os.path.join(pipe_dir, 'pipe')
+        os.mkfifo(path)
+
+        def write():
+            with open(path, 'wb') as f:
+                f.write(b'streamed')
+        Thread(target=write, daemon=True).start()
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "http_method": "POST",
+            "upload": {"source": "file", "file_path": path}
+        })
+        block.start()
+        block.process_signals([Signal()])
+        block.stop()
+        os.remove(path)
+        os.rmdir(pipe_dir)
+        self.assertEqual(bodies, [b'streamed'])
+
+    @patch('requests.post')
+    def test_upload_missing_file(self, mock_post):
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "http_method": "POST",
+            "upload": {"source": "file", "file_path": "/does/not/exist"}
+        })
+        block.start()
+        block.process_signals([Signal()])
+        block.stop()
+        self.assertFalse(mock_post.called)
+        self.assert_num_signals_notified(0)
+
+    @patch('requests.post')
+    def test_upload_attribute_compressed(self, mock_post):
+        from requests.exceptions import ConnectionError
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value={})
+        bodies = []
+
+        def post(*args, **kwargs):
+            # read the whole body each time, then fail the first attempt
+            bodies.append(b''.join(kwargs['data']))
+            if len(bodies) == 1:
+                raise ConnectionError
+            return resp
+        mock_post.side_effect = post
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "http_method": "POST",
+            "upload": {
+                "source": "attribute",
+                "attribute": "{{ $records }}",
+                "compress": True
+            },
+            "retry_options": {"max_retry": 1, "multiplier": 0}
+        })
+        block.start()
+        records = [{'id': i} for i in range(3)]
+        block.process_signals([Signal({'records': records})])
+        block.stop()
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(bodies[0], bodies[1])
+        lines = gzip.decompress(bodies[1]).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], records)
+        headers = mock_post.call_args[1]['headers']
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+
+    @patch('requests.get')
+    def test_concurrent_requests(self, mock_get):
+        lock = Lock()
+        active = []
+        peak = [0]
+
+        def get(url, **kwargs):
+            with lock:
+                active.append(url)
+                peak[0] = max(peak[0], len(active))
+            sleep(0.05)
+            with lock:
+                active.remove(url)
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.json = MagicMock(return_value={'url': url})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "url": "http://example.com/{{ $n }}",
+            "concurrency": {
+                "enabled": True,
+                "adaptive": False,
+                "initial_limit": 3
+            }
+        })
+        block.start()
+        block.process_signals([Signal({'n': n}) for n in range(6)])
+        block.stop()
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(
+            [s.url for s in self.last_notified[DEFAULT_TERMINAL]],
+            ["http://example.com/{}".format(n) for n in range(6)])
+
+    @patch('requests.get')
+    def test_concurrency_backs_off_on_throttling(self, mock_get):
+        resp = MagicMock()
+        resp.status_code = 429
+        resp.json = MagicMock(return_value={})
+        mock_get.return_value = resp
+        block = HTTPRequests()
+        self.assertEqual(block.concurrency_status(), {'enabled': False})
+        self.configure_block(block, {
+            "concurrency": {
+                "enabled": True,
+                "initial_limit": 10,
+                "min_limit": 2,
+                "backoff_ratio": 0.5
+            }
+        })
+        block.start()
+        block.process_signals([Signal()])
+        status = block.concurrency_status()
+        block.stop()
+        self.assertEqual(status['limit'], 5)
+        self.assertEqual(
+            [(h['limit'], h['reason']) for h in status['history']],
+            [(10, 'initial'), (5, 'error')])
+
+    @patch('requests.get')
+    def test_projection(self, mock_get):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value=[
+            {'id': 1, 'user': {'name': 'a', 'email': 'a@x', 'bio': '...'},
+             'tags': [{'name': 't', 'score': 1}]},
+            {'id': 2, 'payload': 'large'},
+        ])
+        mock_get.return_value = resp
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "projection": {
+                "include": [
+                    {"path": "id"}, {"path": "user"}, {"path": "tags.name"}
+                ],
+                "exclude": [{"path": "user.bio"}]
+            }
+        })
+        block.start()
+        block.process_signals([Signal()])
+        block.stop()
+        self.assertDictEqual(
+            self.last_notified[DEFAULT_TERMINAL][0].to_dict(), {
+                'id': 1,
+                'user': {'name': 'a', 'email': 'a@x'},
+                'tags': [{'name': 't'}],
+            })
+        self.assertDictEqual(
+            self.last_notified[DEFAULT_TERMINAL][1].to_dict(), {'id': 2})
+
+    @patch('requests.get')
+    def test_tracing_to_file(self, mock_get):
+        from requests.exceptions import Timeout
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.content = b'{"id": 1}'
+        resp.json = MagicMock(return_value={'id': 1})
+        mock_get.side_effect = [Timeout, resp]
+        trace_dir = tempfile.mkdtemp()
+        path = os.path.join(trace_dir, 'spans.jsonl')
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "url": "http://example.com/{{ $n }}",
+            "retry_options": {"max_retry": 1, "multiplier": 0},
+            "tracing": {"enabled": True, "file_path": path}
+        })
+        block.start()
+        block.process_signals([Signal({'n': 1})])
+        block.stop()
+        with open(path) as f:
+            lines = f.readlines()
+        os.remove(path)
+        os.rmdir(trace_dir)
+        self.assertEqual(len(lines), 1)
+        spans = json.loads(lines[0])[
+            'resourceSpans'][0]['scopeSpans'][0]['spans']
+        by_name = {}
+        for span in spans:
+            by_name.setdefault(span['name'], []).append(span)
+        root = by_name['http.request'][0]
+        self.assertNotIn('parentSpanId', root)
+        attributes = {a['key']: a['value'] for a in root['attributes']}
+        self.assertEqual(attributes['url.template'],
+                         {'stringValue': 'http://example.com/{{ $n }}'})
+        self.assertEqual(attributes['http.response.status_code'],
+                         {'intValue': '200'})
+        attempts = by_name['http.attempt']
+        self.assertEqual(len(attempts), 2)
+        self.assertIn('status', attempts[0])
+        self.assertNotIn('status', attempts[1])
+        self.assertEqual(
+            [a['attributes'][0] for a in attempts],
+            [{'key': 'attempt', 'value': {'intValue': str(n)}}
+             for n in (1, 2)])
+        for name in ('evaluate', 'http.attempt', 'process_response'):
+            for span in by_name[name]:
+                self.assertEqual(span['parentSpanId'], root['spanId'])
+                self.assertEqual(span['traceId'], root['traceId'])
+
+    @patch('requests.get')
+    def test_tracing_sampled_out(self, mock_get):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value={})
+        mock_get.return_value = resp
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, trace_dir)
+        path = os.path.join(trace_dir, 'spans.jsonl')
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "tracing": {"enabled": True, "sample_rate": 0, "file_path": path}
+        })
+        block.start()
+        with patch.object(http_requests_base, '_body_size') as body_size:
+            block.process_signals([Signal(), Signal()])
+        block.stop()
+        self.assertFalse(body_size.called)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(self.last_notified[DEFAULT_TERMINAL]), 2)
+
+    @patch('requests.post')
+    def test_tracing_form_body_size(self, mock_post):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.content = 'é'.encode()
+        resp.json = MagicMock(return_value={})
+        mock_post.return_value = resp
+        trace_dir = tempfile.mkdtemp()
+        path = os.path.join(trace_dir, 'spans.jsonl')
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "http_method": "POST",
+            "data": {
+                "params": [{"key": "q", "value": "a é"}],
+                "form_encode_data": True
+            },
+            "tracing": {
+                "enabled": True, "file_path": path, "flush_interval": 0}
+        })
+        self.assertEqual(block._tracer._flush_interval, 1)
+        block.start()
+        block.process_signals([Signal()])
+        block.stop()
+        with open(path) as f:
+            spans = json.loads(f.read())[
+                'resourceSpans'][0]['scopeSpans'][0]['spans']
+        os.remove(path)
+        os.rmdir(trace_dir)
+        attempt = [s for s in spans if s['name'] == 'http.attempt'][0]
+        attributes = {a['key']: a['value'] for a in attempt['attributes']}
+        # q=a+%C3%A9
+        self.assertEqual(attributes['http.request.body.size'],
+                         {'intValue': '10'})
+        self.assertEqual(attributes['http.response.body.size'],
+                         {'intValue': '2'})
+
+    @patch('requests.get')
+    def test_polling_emits_changes_only(self, mock_get):
+        def response(status, content, headers=None):
+            resp = MagicMock()
+            resp.status_code = status
+            resp.content = content
+            resp.headers = headers or {}
+            resp.json = MagicMock(return_value={'body': content.decode()})
+            return resp
+        responses = [
+            response(200, b'a', {'ETag': '"1"'}),
+            response(304, b''),
+            response(200, b'a'),
+            response(200, b'b'),
+        ]
+        polled = Event()
+
+        def get(url, **kwargs):
+            # the fifth poll only starts once the fourth has been emitted
+            if mock_get.call_count == 5:
+                polled.set()
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "url": "http://example.com/{{ $n }}",
+            "polling": {"enabled": True, "interval": 0.01, "jitter": 0}
+        })
+        block.start()
+        block.process_signals([Signal({'n': 1})])
+        self.assertTrue(polled.wait(1))
+        block.stop()
+        headers = [c[1]['headers'] for c in mock_get.call_args_list[:4]]
+        self.assertEqual(headers, [
+            {},
+            {'If-None-Match': '"1"'},
+            {'If-None-Match': '"1"'},
+            {},
+        ])
+        self.assert_num_signals_notified(2)
+
+    @patch('requests.get')
+    def test_polling_repeated_errors_emitted_once(self, mock_get):
+        polled = Event()
+        statuses = [503] * 5 + [200]
+
+        def get(url, **kwargs):
+            if mock_get.call_count == len(statuses) + 1:
+                polled.set()
+            resp = MagicMock()
+            resp.status_code = statuses[min(mock_get.call_count,
+                                            len(statuses)) - 1]
+            resp.content = b'busy' if resp.status_code == 503 else b'ok'
+            resp.headers = {}
+            resp.json = MagicMock(return_value={})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "polling": {"enabled": True, "interval": 0.01, "jitter": 0}
+        })
+        block.start()
+        block.process_signals([Signal()])
+        self.assertTrue(polled.wait(1))
+        block.stop()
+        self.assertEqual(
+            [s._resp['status_code']
+             for s in self.last_notified[DEFAULT_TERMINAL]], [503, 200])
+
+    @patch('requests.get')
+    def test_polling_slow_target_and_eviction(self, mock_get):
+        release = Event()
+        polled = Event()
+        urls = []
+
+        def get(url, **kwargs):
+            urls.append(url)
+            if url.endswith('slow'):
+                release.wait(1)
+            elif urls.count(url) == 3:
+                polled.set()
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.content = url.encode()
+            resp.json = MagicMock(return_value={})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "url": "http://example.com/{{ $n }}",
+            "polling": {"enabled": True, "interval": 0.01, "jitter": 0,
+                        "workers": 2, "max_targets": 2}
+        })
+        block.start()
+        block.process_signals([Signal({'n': 'slow'}), Signal({'n': 'fast'})])
+        # the hung target doesn't hold up the other one
+        self.assertTrue(polled.wait(1))
+        block.process_signals([Signal({'n': 'new'})])
+        self.assertEqual(block._poller.target_count, 2)
+        release.set()
+        sleep(0.1)
+        block.stop()
+        self.assertEqual(urls.count('http://example.com/slow'), 1)
+        self.assertIn('http://example.com/new', urls)
+
+    @patch('requests.get')
+    def test_record_and_replay(self, mock_get):
+        from requests import Response
+        from requests.exceptions import ConnectionError
+        resp = Response()
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.headers['Content-Type'] = 'application/json'
+        resp.headers['Set-Cookie'] = 'session=SECRETSESSION'
+        resp._content = b'{"id": 1}'
+        mock_get.side_effect = [resp, ConnectionError('refused')]
+        log_dir = tempfile.mkdtemp()
+        path = os.path.join(log_dir, 'traffic.jsonl.gz')
+        config = {
+            "url": "http://example.com/{{ $n }}",
+            "headers": [{"header": "Authorization", "value": "secret"}],
+            "retry_options": {"max_retry": 0},
+            "traffic": {"mode": "record", "log_path": path}
+        }
+        block = HTTPRequests()
+        self.configure_block(block, config)
+        block.start()
+        block.process_signals([Signal({'n': 1}), Signal({'n': 2})])
+        block.stop()
+        with gzip.open(path, 'rt') as f:
+            log = f.read()
+        self.assertNotIn('secret', log)
+        self.assertNotIn('SECRETSESSION', log)
+
+        recorded = len(self.last_notified[DEFAULT_TERMINAL])
+        mock_get.reset_mock()
+        config["traffic"] = {
+            "mode": "replay", "log_path": path, "speedup": 1000}
+        block = HTTPRequests()
+        self.configure_block(block, config)
+        block.start()
+        block.process_signals([Signal({'n': 1})] * 2 + [Signal({'n': 2})])
+        block.stop()
+        os.remove(path)
+        os.rmdir(log_dir)
+        self.assertFalse(mock_get.called)
+        replayed = self.last_notified[DEFAULT_TERMINAL][recorded:]
+        self.assertEqual([s.id for s in replayed], [1, 1])
+        self.assertEqual(replayed[0]._resp['status_code'], 200)
+
+    def test_traffic_requires_log_path(self):
+        for mode in ('record', 'replay'):
+            block = HTTPRequests()
+            with self.assertRaises(ValueError):
+                self.configure_block(block, {"traffic": {"mode": mode}})
+
+    @patch('requests.get')
+    def test_record_stopped_in_flight(self, mock_get):
+        from requests import Response
+        started, release = Event(), Event()
+
+        def get(url, **kwargs):
+            started.set()
+            release.wait(1)
+            resp = Response()
+            resp.status_code = 200
+            resp._content = b'{}'
+            return resp
+        mock_get.side_effect = get
+        log_dir = tempfile.mkdtemp()
+        path = os.path.join(log_dir, 'traffic.jsonl')
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "concurrency": {"enabled": True},
+            "traffic": {"mode": "record", "log_path": path}
+        })
+        block.start()
+        thread = Thread(target=block.process_signals, args=([Signal()],))
+        thread.start()
+        self.assertTrue(started.wait(1))
+        block.stop()
+        release.set()
+        thread.join(1)
+        os.remove(path)
+        os.rmdir(log_dir)
+        # the finished request isn't retried because the log was closed
+        self.assertEqual(mock_get.call_count, 1)
+        self.assert_num_signals_notified(1)
+
+    @patch('requests.get')
+    def test_priority_lanes(self, mock_get):
+        def get(url, **kwargs):
+            sleep(0.05)
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.json = MagicMock(return_value={'url': url})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "url": "http://example.com/{{ $name }}",
+            "concurrency": {
+                "enabled": True, "adaptive": False, "initial_limit": 1},
+            "priority": {
+                "lane": "{{ $lane }}",
+                "lanes": [
+                    {"name": "alert"},
+                    {"name": "bulk", "share": 0.5, "deadline": 0.08}
+                ]
+            }
+        })
+        block.start()
+        block.process_signals(
+            [Signal({'name': n, 'lane': 'bulk'}) for n in ('b1', 'b2', 'b3')] +
+            [Signal({'name': 'a1', 'lane': 'alert'})])
+        status = block.concurrency_status()
+        block.stop()
+        urls = [c[0][0] for c in mock_get.call_args_list]
+        # the alert goes ahead of queued bulk requests, which then wait
+        # past their deadline
+        self.assertIn(urls, [
+            ['http://example.com/b1', 'http://example.com/a1'],
+            ['http://example.com/a1', 'http://example.com/b1'],
+        ])
+        self.assert_num_signals_notified(2)
+        lanes = status['lanes']
+        self.assertEqual(lanes['alert']['completed'], 1)
+        self.assertEqual(lanes['bulk']['completed'], 1)
+        self.assertEqual(lanes['bulk']['dropped'], 2)
+        self.assertEqual(lanes['bulk']['queued'], 0)
+        self.assertGreater(lanes['alert']['latency'], 0)
+
+    @patch('requests.get')
+    def test_priority_deadline_while_saturated(self, mock_get):
+        release = Event()
+
+        def get(url, **kwargs):
+            release.wait(1)
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.json = MagicMock(return_value={})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "concurrency": {
+                "enabled": True, "adaptive": False, "initial_limit": 1},
+            "priority": {
+                "lane": "bulk",
+                "lanes": [{"name": "bulk", "deadline": 0.05}]
+            }
+        })
+        block.start()
+        thread = Thread(target=block.process_signals,
+                        args=([Signal(), Signal()],))
+        thread.start()
+        sleep(0.2)
+        # the queued request is dropped while the first one still runs
+        status = block.concurrency_status()
+        release.set()
+        thread.join(1)
+        block.stop()
+        self.assertEqual(status['in_flight'], 1)
+        self.assertEqual(status['lanes']['bulk']['queued'], 0)
+        self.assertEqual(status['lanes']['bulk']['dropped'], 1)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('requests.post')
+    @patch('requests.get')
+    def test_oauth2_token_cached_and_retried(self, mock_get, mock_post):
+        tokens = []
+        for token in ('t1', 't2'):
+            token_resp = MagicMock()
+            token_resp.json = MagicMock(
+                return_value={'access_token': token, 'expires_in': 3600})
+            tokens.append(token_resp)
+        mock_post.side_effect = tokens
+        sent = []
+
+        def get(url, auth, **kwargs):
+            request = auth(MagicMock(headers={}))
+            sent.append(request.headers['Authorization'])
+            resp = MagicMock()
+            resp.status_code = 401 if len(sent) == 1 else 200
+            resp.json = MagicMock(return_value={})
+            return resp
+        mock_get.side_effect = get
+        block = HTTPRequests()
+        self.configure_block(block, {
+            "oauth2_creds": {
+                "token_url": "http://auth.example.com/token",
+                "client_id": "id",
+                "client_secret": "secret",
+                "scope": "read"
+            }
+        })
+        block.start()
+        block.process_signals([Signal()])
+        block.process_signals([Signal()])
+        block.stop()
+        self.assertEqual(sent, ['Bearer t1', 'Bearer t2', 'Bearer t2'])
+        self.assertEqual(mock_post.call_count, 2)
+        mock_post.assert_called_with(
+            "http://auth.example.com/token",
+            data={'grant_type': 'client_credentials', 'scope': 'read'},
+            auth=('id', 'secret'), verify=True, timeout=None)
+        self.assertEqual(
+            self.last_notified[DEFAULT_TERMINAL][0]._resp['status_code'], 200)
+
+    @patch('requests.Session.request')
+    def test_shared_connection_pool(self, mock_request):
+        resp = MagicMock()
+        resp.status_code = 200
+        resp.json = MagicMock(return_value={})
+        mock_request.return_value = resp
+        config = {
+            "url": "https://example.com",
+            "timeout": 5,
+            "connection_pool": {"name": "internal"}
+        }
+        block1, block2, block3 = HTTPRequests(), HTTPRequests(), HTTPRequests()
+        self.configure_block(block1, config)
+        self.configure_block(block2, config)
+        self.configure_block(block3, dict(config, verify=False))
+        for block in (block1, block2, block3):
+            block.start()
+        self.assertIs(block1._pool, block2._pool)
+        self.assertIsNot(block1._pool, block3._pool)
+        self.assertEqual(block1._pool.users, 2)
+        self.assertFalse(block3._pool.session.verify)
+        block1.process_signals([Signal()])
+        mock_request.assert_called_once_with(
+            'get', 'https://example.com', verify=True, cert=None,
+            auth=None, data={}, headers={}, timeout=5)
+        with patch.dict(os.environ, {'REQUESTS_CA_BUNDLE': '/ca.pem'}):
+            block3.process_signals([Signal()])
+        self.assertFalse(mock_request.call_args[1]['verify'])
+        pool = block1._pool
+        block1.stop()
+        self.assertEqual(pool.users, 1)
+        with patch.object(pool.session, 'close') as close:
+            block2.stop()
+            close.assert_called_once_with()
+        block3.stop()
+
+    def test_shared_connection_pool_keeps_no_cookies(self):
+        cookies = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                cookies.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'session=' + self.path[1:])
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        block1, block2 = HTTPRequests(), HTTPRequests()
+        self.configure_block(block1, {
+            "url": url + "a", "connection_pool": {"name": "cookies"}})
+        self.configure_block(block2, {
+            "url": url + "b", "connection_pool": {"name": "cookies"}})
+        block1.start()
+        block2.start()
+        block1.process_signals([Signal()])
+        block2.process_signals([Signal()])
+        block1.process_signals([Signal()])
+        block1.stop()
+        block2.stop()
+        self.assertEqual(cookies, [None, None, None])
+        self.assert_num_signals_notified(3)
@@ -0,0 +1,233 @@
+import json
+import os
+import random
+from contextlib import contextmanager
+from threading import Event, Lock
+from time import time_ns
+
+import requests
+from nio.properties import (BoolProperty, FloatProperty, IntProperty,
+                            PropertyHolder, StringProperty)
+from nio.util.threading import spawn
+
+
+class Tracing(PropertyHolder):
+    enabled = BoolProperty(title='Enable Tracing',
+                           default=False,
+                           allow_expr=False,
+                           order=0)
+    sample_rate = FloatProperty(title='Sample Rate (0-1)',
+                                default=1.0,
+                                allow_expr=False,
+                                order=1)
+    file_path = StringProperty(title='Export to File',
+                               allow_none=True,
+                               allow_expr=False,
+                               order=2)
+    endpoint = StringProperty(title='Export to OTLP/HTTP Endpoint',
+                              allow_none=True,
+                              allow_expr=False,
+                              order=3)
+    flush_interval = IntProperty(title='Flush Interval (seconds)',
+                                 default=5,
+                                 allow_expr=False,
+                                 order=4)
+
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+
+def _attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span(object):
+
+    """ One timed stage of a request, serializable as an OTLP span """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind',
+                 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace_id, parent_id, name, kind, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = str(error)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [{'key': key, 'value': _attribute_value(value)}
+                           for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+class _NullSpan(object):
+
+    def set(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+
+class NullTrace(object):
+
+    """ Stands in for a trace when a request isn't sampled """
+
+    _span = _NullSpan()
+
+    def next_attempt(self):
+        return 0
+
+    @contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        yield self._span
+
+
+NULL_TRACE = NullTrace()
+
+
+class Trace(object):
+
+    """ The spans recorded for one request, handed to the tracer once the
+    outermost span ends.
+    """
+
+    def __init__(self, tracer):
+        self._tracer = tracer
+        self._trace_id = os.urandom(16).hex()
+        self._stack = []
+        self._spans = []
+        self._attempts = 0
+
+    def next_attempt(self):
+        self._attempts += 1
+        return self._attempts
+
+    @contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, **attributes):
+        parent_id = self._stack[-1].span_id if self._stack else None
+        span = Span(self._trace_id, parent_id, name, kind, attributes)
+        self._stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_error(e)
+            raise
+        finally:
+            span.end = time_ns()
+            self._stack.pop()
+            self._spans.append(span)
+            if not self._stack:
+                self._tracer.export(self._spans)
+
+
+class Tracer(object):
+
+    """ Samples request traces and exports their spans in batches.
+
+    Spans are written as OTLP/JSON export requests, one per line when
+    exporting to a file, or POSTed to an OTLP/HTTP collector endpoint.
+    Exporting happens on a background thread every `flush_interval`
+    seconds so it stays off the request path.
+    """
+
+    scope = 'nio.blocks.http_requests'
+
+    # shortest pause between exports, so a zero interval can't busy loop
+    min_flush_interval = 1
+
+    def __init__(self, service_name, sample_rate=1.0, file_path=None,
+                 endpoint=None, flush_interval=5, logger=None):
+        self._resource = {'attributes': [
+            {'key': 'service.name', 'value': _attribute_value(service_name)}
+        ]}
+        self._sample_rate = sample_rate
+        self._file_path = file_path
+        self._endpoint = endpoint
+        self._flush_interval = max(flush_interval, self.min_flush_interval)
+        self._logger = logger
+        self._pending = []
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = spawn(self._run)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def start_trace(self):
+        """ Return a new Trace, or NULL_TRACE if this one isn't sampled """
+        if random.random() < self._sample_rate:
+            return Trace(self)
+        return NULL_TRACE
+
+    def export(self, spans):
+        with self._lock:
+            self._pending.extend(spans)
+
+    def flush(self):
+        with self._lock:
+            spans, self._pending = self._pending, []
+        if not spans:
+            return
+        document = json.dumps({'resourceSpans': [{
+            'resource': self._resource,
+            'scopeSpans': [{
+                'scope': {'name': self.scope},
+                'spans': [span.to_otlp() for span in spans],
+            }],
+        }]})
+        try:
+            if self._file_path:
+                with open(self._file_path, 'a') as f:
+                    f.write(document + '\n')
+            if self._endpoint:
+                requests.post(self._endpoint, data=document,
+                              headers={'Content-Type': 'application/json'},
+                              timeout=self._flush_interval)
+        except Exception as e:
+            if self._logger:
+                self._logger.warning(
+                    "Failed to export {} spans: {}".format(len(spans), e))
+
+    def _run(self):
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
@@ -0,0 +1,170 @@
+import base64
+import gzip
+import json
+from collections import defaultdict, deque
+from datetime import timedelta
+from enum import Enum
+from threading import Lock
+from time import sleep, time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from nio.properties import (BoolProperty, FloatProperty, PropertyHolder,
+                            SelectProperty, StringProperty)
+
+
+class TrafficMode(Enum):
+    OFF = 'off'
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+
+class Traffic(PropertyHolder):
+    mode = SelectProperty(TrafficMode,
+                          title='Mode',
+                          default=TrafficMode.OFF,
+                          allow_expr=False,
+                          order=0)
+    log_path = StringProperty(title='Traffic Log',
+                              allow_none=True,
+                              allow_expr=False,
+                              order=1)
+    reproduce_latency = BoolProperty(title='Reproduce Recorded Latency',
+                                     default=True,
+                                     allow_expr=False,
+                                     order=2)
+    speedup = FloatProperty(title='Latency Speedup',
+                            default=1.0,
+                            allow_expr=False,
+                            order=3)
+
+
+# credentials are never written to the log
+REDACTED_HEADERS = ('authorization', 'proxy-authorization', 'cookie')
+REDACTED_RESPONSE_HEADERS = ('set-cookie', 'set-cookie2',
+                             'www-authenticate', 'proxy-authenticate')
+
+
+def _redact(headers, redacted):
+    return {key: value for key, value in (headers or {}).items()
+            if key.lower() not in redacted}
+
+
+def _open(path, mode):
+    """ Open a log as text, gzip compressed if its name ends in .gz """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def _encode_body(body):
+    if isinstance(body, str):
+        return {'text': body}
+    if isinstance(body, bytes):
+        try:
+            return {'text': body.decode()}
+        except UnicodeDecodeError:
+            return {'base64': base64.b64encode(body).decode()}
+    if isinstance(body, dict):
+        return {'form': body}
+    if body is None:
+        return None
+    return {'stream': repr(body)}
+
+
+def _decode_body(body):
+    if not body:
+        return b''
+    if 'text' in body:
+        return body['text'].encode()
+    if 'base64' in body:
+        return base64.b64decode(body['base64'])
+    return b''
+
+
+class TrafficRecorder(object):
+
+    """ Appends each request and its response or error to a log, one JSON
+    object per line. Requests recorded after the log is closed are dropped.
+    """
+
+    def __init__(self, path):
+        self._file = _open(path, 'a')
+        self._lock = Lock()
+
+    def record(self, method, url, headers, body, elapsed, response=None,
+               error=None):
+        entry = {
+            'time': time(),
+            'method': method,
+            'url': url,
+            'headers': _redact(headers, REDACTED_HEADERS),
+            'body': _encode_body(body),
+            'elapsed': elapsed,
+        }
+        if response is not None:
+            entry['status'] = response.status_code
+            entry['reason'] = response.reason
+            entry['response_headers'] = _redact(
+                response.headers, REDACTED_RESPONSE_HEADERS)
+            entry['encoding'] = response.encoding
+            entry['content'] = _encode_body(response.content)
+        else:
+            entry['error'] = str(error)
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TrafficReplayer(object):
+
+    """ Serves responses from a recorded traffic log.
+
+    Recorded exchanges are matched on method and url. When a url was
+    recorded several times its entries are served in turn, over and over,
+    so a short recording can drive a long load test.
+    """
+
+    def __init__(self, path, reproduce_latency=True, speedup=1.0):
+        self._entries = defaultdict(deque)
+        self._lock = Lock()
+        self._reproduce_latency = reproduce_latency
+        self._speedup = speedup
+        with _open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[(entry['method'], entry['url'])].append(
+                        entry)
+
+    @property
+    def entry_count(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def respond(self, method, url):
+        key = (method, url)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise requests.ConnectionError(
+                    "No recorded response for {} {}".format(method, url))
+            entry = entries[0]
+            entries.rotate(-1)
+        if self._reproduce_latency and self._speedup > 0:
+            sleep(entry['elapsed'] / self._speedup)
+        if 'error' in entry:
+            raise requests.ConnectionError(entry['error'])
+        response = requests.Response()
+        response.url = url
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['response_headers'])
+        response.encoding = entry['encoding']
+        response.elapsed = timedelta(seconds=entry['elapsed'])
+        response._content = _decode_body(entry['content'])
+        return response
@@ -0,0 +1,139 @@
+import json
+import mmap
+import zlib
+from enum import Enum
+from time import monotonic
+
+from nio.properties import (Property, IntProperty, BoolProperty,
+                            PropertyHolder, SelectProperty, StringProperty)
+
+
+class UploadSource(Enum):
+    NONE = 'none'
+    FILE = 'file'
+    ATTRIBUTE = 'attribute'
+
+
+class Upload(PropertyHolder):
+    source = SelectProperty(UploadSource,
+                            title='Stream Body From',
+                            default=UploadSource.NONE,
+                            order=0)
+    file_path = StringProperty(title='File Path', allow_none=True, order=1)
+    attribute = Property(title='List Attribute', allow_none=True, order=2)
+    chunk_size = IntProperty(title='Chunk Size (bytes)',
+                             default=65536,
+                             order=3)
+    compress = BoolProperty(title='Gzip Compress Body',
+                            default=False,
+                            order=4)
+
+
+def file_chunks(path, chunk_size):
+    """ Read a file in chunks, memory-mapping it when the OS allows. """
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files and special files (pipes, sockets) can't be mapped
+            mapped = None
+        if mapped is None:
+            chunk = f.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = f.read(chunk_size)
+            return
+        with mapped:
+            for offset in range(0, len(mapped), chunk_size):
+                yield mapped[offset:offset + chunk_size]
+
+
+def list_chunks(items, chunk_size):
+    """ Serialize a list as newline-delimited JSON, buffered into chunks. """
+    buffer = bytearray()
+    for item in items:
+        buffer.extend(json.dumps(item).encode())
+        buffer.extend(b'\n')
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class UploadStream(object):
+
+    """ A request body that is produced lazily, one chunk at a time.
+
+    requests sends iterables of unknown length with chunked transfer
+    encoding, so the body never has to be held in memory. Every call to
+    `__iter__` starts over from the source, which lets the Retry mixin
+    re-send the same body.
+
+    Args:
+        chunks (callable): Returns a fresh iterator of bytes chunks.
+        description (str): Human readable name of the source, for logs.
+        logger: Logger used to report upload progress.
+        compress (bool): Gzip the body on the fly.
+        total (int): Size of the uncompressed source, if known.
+    """
+
+    progress_interval = 5
+
+    def __init__(self, chunks, description, logger, compress=False,
+                 total=None):
+        self._chunks = chunks
+        self._description = description
+        self._logger = logger
+        self._compress = compress
+        self._total = total
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        self.elapsed = 0
+
+    @property
+    def rate(self):
+        """ Upload throughput of the last pass over the body, in bytes/sec """
+        return self.bytes_sent / self.elapsed if self.elapsed else 0
+
+    def __iter__(self):
+        compressor = zlib.compressobj(wbits=31) if self._compress else None
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        start = last_report = monotonic()
+        for chunk in self._chunks():
+            self.bytes_read += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            self.bytes_sent += len(chunk)
+            yield chunk
+            now = monotonic()
+            self.elapsed = now - start
+            if now - last_report >= self.progress_interval:
+                last_report = now
+                self._report_progress()
+        if compressor:
+            chunk = compressor.flush()
+            self.bytes_sent += len(chunk)
+            yield chunk
+        self.elapsed = monotonic() - start
+        self._logger.info(
+            "Uploaded {} bytes from {} in {:.2f}s ({:.0f} bytes/sec)"
+            .format(self.bytes_sent, self._description,
+                    self.elapsed, self.rate))
+
+    def _report_progress(self):
+        if self._total:
+            progress = " ({:.1f}%)".format(
+                100.0 * self.bytes_read / self._total)
+        else:
+            progress = ""
+        self._logger.debug(
+            "Uploading {}: {} bytes read{}, {} bytes sent at {:.0f} bytes/sec"
+            .format(self._description, self.bytes_read, progress,
+                    self.bytes_sent, self.rate))
+
+    def __repr__(self):
+        return "<UploadStream {}>".format(self._description)